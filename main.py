@@ -1,12 +1,73 @@
 #!/usr/bin/env python3
 
 import argparse
-import subprocess
+import asyncio
+import codecs
+import hashlib
+import json
+import random
+import re
 import os
 import sys
-import time
+from concurrent.futures import ThreadPoolExecutor
 from shutil import copytree
-from openai import OpenAI
+import tiktoken
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+
+# Version of the fix format stored in the cache; bump it when the format of cached fixes changes
+CACHE_FORMAT_VERSION = 'patches-v2'
+# Fraction of the model's context window a single prompt may use before the files are split up
+CONTEXT_USAGE_THRESHOLD = 0.7
+# Maximum number of concurrent OpenAI calls when fixing files one at a time
+MAX_CONCURRENT_FIXES = 4
+# Number of times the OpenAI client retries rate limited or failed requests, with exponential backoff
+OPENAI_MAX_RETRIES = 5
+# Number of characters of tofu output sent when asking the model which files to fix
+FILE_SELECTION_OUTPUT_LIMIT = 4000
+# Directories that are never sent to the model
+IGNORED_DIRECTORIES = frozenset({'.terraform', '.git', '__pycache__'})
+# Suffixes of state, plan and lock files that are never sent to the model
+IGNORED_SUFFIXES = ('.tfstate', '.tfstate.backup', '.tfplan', '.lock.hcl')
+# Files larger than this many bytes are never sent to the model
+MAX_FILE_SIZE = 512 * 1024
+# Matches Terraform filenames referenced in the tofu output
+TF_FILENAME_PATTERN = re.compile(r'[\w./-]+\.tf(?:\.json)?\b')
+# Matches a unified diff hunk header, capturing the start line and line count in the original
+# file and the line count in the new file
+HUNK_HEADER_PATTERN = re.compile(r'^@@ -(\d+)(?:,(\d+))? \+\d+(?:,(\d+))? @@')
+# Tool the model must call to return its fixes as unified diffs instead of whole files
+PATCH_TOOL = {
+    'type': 'function',
+    'function': {
+        'name': 'apply_patches',
+        'description': 'Applies unified diffs to the Terraform files to fix the tofu output.',
+        'parameters': {
+            'type': 'object',
+            'properties': {
+                'patches': {
+                    'type': 'array',
+                    'items': {
+                        'type': 'object',
+                        'properties': {
+                            'filename': {
+                                'type': 'string',
+                                'description': 'Filename exactly as given in the [START FILE] marker.'
+                            },
+                            'diff': {
+                                'type': 'string',
+                                'description': 'Unified diff of the changes to the file, with @@ hunk headers and 3 lines of context. Diff a new file against an empty file.'
+                            }
+                        },
+                        'required': ['filename', 'diff'],
+                        'additionalProperties': False
+                    }
+                }
+            },
+            'required': ['patches'],
+            'additionalProperties': False
+        }
+    }
+}
 
 def parse_arguments():
     parser = argparse.ArgumentParser(description="Automate tofu planning and fixing using OpenAI GPT-4.")
@@ -17,12 +78,19 @@ def parse_arguments():
     parser.add_argument('--openai-api-key', default=None, help='OpenAI API key. Alternatively, set the OPENAI_API_KEY environment variable.')
     parser.add_argument('--openai-model', default='gpt-4o-mini-2024-07-18', help='OpenAI model name. Default is "gpt-4".')
     parser.add_argument('--max-retries', type=int, default=5, help='Maximum number of retries for fixing.')
-    parser.add_argument('--sleep-interval', type=int, default=10, help='Seconds to wait between retries.')
+    parser.add_argument('--sleep-interval', type=float, default=1, help='Initial seconds to wait between retries. Doubled after every attempt.')
+    parser.add_argument('--max-sleep-interval', type=float, default=60, help='Maximum seconds to wait between retries.')
+    parser.add_argument('--allow-changes', action='store_true', help='Treat a plan with changes (exit code 2) as success instead of asking the model to remove the drift.')
+    parser.add_argument('--select-files', action='store_true', help='First ask the model which files need fixing and only send those files.')
+    parser.add_argument('--context-limit', type=int, default=128000, help='Context window of the OpenAI model in tokens. Default is 128000.')
+    parser.add_argument('--cache-dir', default=os.path.expanduser('~/.cf-tofu-cache'), help='Directory for caching OpenAI fixes. Default is "~/.cf-tofu-cache".')
+    parser.add_argument('--no-cache', action='store_true', help='Don\'t reuse cached fixes. New fixes are still written to the cache.')
     return parser.parse_args()
 
 def initialize_openai(api_key):
     """
     Initializes the OpenAI API client with the provided API key.
+    Uses HTTP/2 so concurrent requests share a single connection.
     """
     if api_key:
         key = api_key
@@ -31,72 +99,180 @@ def initialize_openai(api_key):
         if not key:
             print("Error: OpenAI API key not provided. Use the '--openai-api-key' argument or set the OPENAI_API_KEY environment variable.")
             sys.exit(1)
-    client = OpenAI(
-        api_key=key
+    client = AsyncOpenAI(
+        api_key=key,
+        max_retries=OPENAI_MAX_RETRIES,
+        http_client=DefaultAsyncHttpxClient(http2=True)
     )
     return client
 
-def run_tofu(tf_bin, working_folder):
+async def _drain_stream(stream, accumulated_output):
     """
-    Runs the tofu binary with 'plan -detailed-exitcode' arguments.
-    Streams the output in real-time.
+    Copies a subprocess stream to stdout as it arrives and appends it to accumulated_output.
+    stdout's own buffering decides when it is written out.
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    while True:
+        chunk = await stream.read(65536)
+        if not chunk:
+            break
+        sys.stdout.write(decoder.decode(chunk))
+        accumulated_output += chunk
+    sys.stdout.write(decoder.decode(b'', final=True))
+
+def tofu_environment():
+    """
+    Returns the environment for running tofu, with a shared provider plugin cache
+    so 'tofu init' doesn't download providers again for every fresh output folder.
+    An existing TF_PLUGIN_CACHE_DIR setting is respected.
+    """
+    env = dict(os.environ)
+    plugin_cache_dir = env.setdefault('TF_PLUGIN_CACHE_DIR', os.path.expanduser('~/.terraform.d/plugin-cache'))
+    os.makedirs(plugin_cache_dir, exist_ok=True)
+    return env
+
+async def _run_tofu_command(command, working_folder, env=None):
+    """
+    Runs a tofu command.
+    Streams the output as it arrives, line by line when stdout is a terminal, draining
+    stdout and stderr concurrently so neither pipe can fill up and block the process.
     Returns the exit code and accumulated output.
     """
-    command = [tf_bin, 'plan', '-detailed-exitcode']
     try:
-        process = subprocess.Popen(
-            command,
+        process = await asyncio.create_subprocess_exec(
+            *command,
             cwd=working_folder,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True,
-            bufsize=1,
-            universal_newlines=True
+            env=env,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
         )
 
-        accumulated_output = ""
+        accumulated_output = bytearray()
         print("\n--- Tofu Output ---\n")
-        
-        # Stream stdout
-        if process.stdout:
-            for line in iter(process.stdout.readline, ''):
-                print(line, end='')
-                accumulated_output += line
-        # Stream stderr
-        if process.stderr:
-            for line in iter(process.stderr.readline, ''):
-                print(line, end='')
-                accumulated_output += line
-
-        process.stdout.close()
-        process.stderr.close()
-        return_code = process.wait()
+
+        # Stream stdout and stderr as they become readable
+        await asyncio.gather(
+            _drain_stream(process.stdout, accumulated_output),
+            _drain_stream(process.stderr, accumulated_output)
+        )
+
+        return_code = await process.wait()
         print(f"\nTofu exited with code {return_code}\n")
-        return return_code, accumulated_output
+        return return_code, accumulated_output.decode('utf-8', errors='replace')
     except Exception as e:
         print(f"Error running tofu: {e}")
         sys.exit(1)
 
-def read_all_files(folder):
+async def init_tofu(tf_bin, working_folder, env=None):
+    """
+    Runs 'tofu init' in the working folder, installing providers through the plugin cache.
+    Returns the exit code and accumulated output.
+    """
+    return await _run_tofu_command([tf_bin, 'init', '-input=false'], working_folder, env)
+
+async def run_tofu(tf_bin, working_folder, env=None):
+    """
+    Runs the tofu binary with 'plan -detailed-exitcode' arguments.
+    Returns the exit code and accumulated output.
+    """
+    return await _run_tofu_command([tf_bin, 'plan', '-detailed-exitcode'], working_folder, env)
+
+def _read_file(filepath):
+    """
+    Reads a single file as UTF-8 text and returns its content.
+    The file is read as raw bytes and decoded once, skipping the buffered text layer.
+    """
+    with open(filepath, 'rb', buffering=0) as file:
+        return file.read().decode('utf-8')
+
+def _walk_files(directory, relative_directory):
+    """
+    Yields (relative_path, filepath, stat) tuples for all files below directory using os.scandir,
+    which avoids a stat call per directory entry on most platforms.
+    Like os.walk, symlinks to directories are not followed.
+    Skips IGNORED_DIRECTORIES and files ending in IGNORED_SUFFIXES.
+    """
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            relative_path = os.path.join(relative_directory, entry.name) if relative_directory else entry.name
+            if entry.is_dir():
+                if entry.name not in IGNORED_DIRECTORIES and not entry.is_symlink():
+                    yield from _walk_files(entry.path, relative_path)
+                continue
+            if entry.name.endswith(IGNORED_SUFFIXES):
+                continue
+            yield relative_path, entry.path, entry.stat()
+
+def _list_files(folder):
+    """
+    Returns (relative_path, filepath, stat) tuples for all files in the specified folder.
+    Skips ignored directories and state, plan and lock files.
+    """
+    try:
+        return list(_walk_files(folder, ''))
+    except Exception as e:
+        print(f"Error listing files in {folder}: {e}")
+        sys.exit(1)
+
+def _read_files(paths):
     """
-    Reads all files in the specified folder and returns a dictionary of filename: content.
-    Ignores the '.terraform' directory and its contents.
+    Yields (relative_path, content) pairs for the given (relative_path, filepath) pairs.
+    Files are read concurrently using a thread pool since the work is I/O-bound.
     """
-    files_content = {}
-    for root, dirs, files in os.walk(folder):
-        # Ignore the '.terraform' directory
-        if '.terraform' in dirs:
-            dirs.remove('.terraform')
-        for filename in files:
-            filepath = os.path.join(root, filename)
-            relative_path = os.path.relpath(filepath, folder)
+    max_workers = min(32, (os.cpu_count() or 1) * 4)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [(relative_path, executor.submit(_read_file, filepath)) for relative_path, filepath in paths]
+        for relative_path, future in futures:
             try:
-                with open(filepath, 'r', encoding='utf-8') as file:
-                    files_content[relative_path] = file.read()
+                content = future.result()
             except Exception as e:
                 print(f"Error reading file {relative_path}: {e}")
                 sys.exit(1)
-    return files_content
+            yield relative_path, content
+
+def refresh_files(folder, file_cache):
+    """
+    Returns a dictionary of filename: content for all files in the specified folder,
+    only re-reading files whose modification time or size changed since they were cached.
+    file_cache maps filename to (mtime_ns, size, content) and is updated in place.
+    Skips ignored directories, state, plan and lock files, and files larger than MAX_FILE_SIZE.
+    Skipped large files are cached with a content of None so they are only reported once.
+    """
+    paths = _list_files(folder)
+    stale_paths = []
+    stats = {}
+    for relative_path, filepath, stat in paths:
+        cached = file_cache.get(relative_path)
+        if cached is not None and cached[0] == stat.st_mtime_ns and cached[1] == stat.st_size:
+            continue
+        if stat.st_size > MAX_FILE_SIZE:
+            print(f"Skipping {relative_path}: larger than {MAX_FILE_SIZE // 1024} KiB")
+            file_cache[relative_path] = (stat.st_mtime_ns, stat.st_size, None)
+        else:
+            stale_paths.append((relative_path, filepath))
+            stats[relative_path] = stat
+
+    for relative_path, content in _read_files(stale_paths):
+        stat = stats[relative_path]
+        file_cache[relative_path] = (stat.st_mtime_ns, stat.st_size, content)
+
+    # Forget files that no longer exist
+    current_paths = {relative_path for relative_path, _, _ in paths}
+    for relative_path in list(file_cache):
+        if relative_path not in current_paths:
+            del file_cache[relative_path]
+
+    return {
+        relative_path: file_cache[relative_path][2]
+        for relative_path, _, _ in paths
+        if file_cache[relative_path][2] is not None
+    }
+
+async def refresh_files_async(folder, file_cache):
+    """
+    Refreshes the files in the specified folder in a worker thread so the event loop stays free.
+    """
+    return await asyncio.to_thread(refresh_files, folder, file_cache)
 
 def read_original_template(template_path):
     """
@@ -115,81 +291,518 @@ def read_original_template(template_path):
         print(f"Error reading original CloudFormation template: {e}")
         sys.exit(1)
 
-def send_to_openai(client, model, messages):
+async def send_to_openai(client, model, messages, folder, files_content, echo=True):
     """
-    Sends messages to the OpenAI API and streams the response in real-time.
-    Returns the fixed files content as a dictionary.
+    Sends messages to the OpenAI API and streams the response in real-time, requiring
+    the model to answer with unified diffs through the apply_patches tool.
+    If echo is False the response is not printed, which is used when several requests
+    run concurrently.
+    files_content holds every file read from the output folder, which the diffs are applied to.
+    Returns the fixed files content as a dictionary, which is empty if the response can't be used.
     """
     try:
         print("\n--- Sending to OpenAI GPT-4 Model ---\n")
-        fixed_files_text = ""
-        
+        # Tool call arguments, by tool call index
+        arguments = {}
+        finish_reason = None
+
         # Initialize the streaming context
-        with client.chat.completions.create(
+        async with await client.chat.completions.create(
             model=model,
             messages=messages,
+            tools=[PATCH_TOOL],
+            tool_choice={'type': 'function', 'function': {'name': 'apply_patches'}},
+            parallel_tool_calls=False,
             stream=True
         ) as stream:
-            print("\n--- OpenAI GPT-4 Model Response ---\n")
-            for event in stream:
-                
-                # if 'choices' in event and len(event['choices']) > 0:
-                content = event.choices[0].delta.content
-                # content = delta.get('content', '')
-                if content:
-                    print(content, end='', flush=True)
-                    fixed_files_text += content
-                # else:
-                #     print("failed to get response from OpenAI")
-                #     print(event['choices'])
-
+            if echo:
+                print("\n--- OpenAI GPT-4 Model Response ---\n")
+            async for event in stream:
+                if not event.choices:
+                    continue
+                choice = event.choices[0]
+                finish_reason = choice.finish_reason or finish_reason
+                for tool_call in choice.delta.tool_calls or []:
+                    if tool_call.function and tool_call.function.arguments:
+                        if echo:
+                            sys.stdout.write(tool_call.function.arguments)
+                        arguments.setdefault(tool_call.index, []).append(tool_call.function.arguments)
         print("\n")  # Ensure newline after streaming
-        if not fixed_files_text.strip():
-            print("Received empty response from OpenAI.")
-            sys.exit(1)
-        # Parse the fixed files from the response
-        fixed_files = parse_fixed_files(fixed_files_text)
-        return fixed_files
     except Exception as e:
         print(f"Error communicating with OpenAI: {e}")
         sys.exit(1)
 
-def parse_fixed_files(fixed_files_text):
+    # An unusable response fails this attempt, and the retry loop asks again
+    if finish_reason == 'length':
+        print("OpenAI response was cut off at the maximum length. Discarding it.")
+        return {}
+    if not arguments:
+        print("Received empty response from OpenAI.")
+        return {}
+    patches = []
+    try:
+        for index in sorted(arguments):
+            call_patches = json.loads("".join(arguments[index]))['patches']
+            if not isinstance(call_patches, list):
+                raise ValueError("'patches' is not a list")
+            patches.extend(call_patches)
+    except (ValueError, KeyError, TypeError) as e:
+        print(f"Error parsing patches returned by OpenAI: {e}")
+        return {}
+    return apply_patches(folder, files_content, patches)
+
+def _parse_hunks(diff):
     """
-    Parses the fixed files text returned from the model and returns a dictionary of filename: content.
+    Parses a unified diff into a list of (start, count, ops) hunks, where start and count are
+    the original line range from the hunk header. ops is a list of [kind, text, has_newline]
+    entries, where kind is ' ' for a context line, '-' for a removed line and '+' for an added line.
+    A hunk ends once it holds as many lines as its header says, or early at a line that isn't
+    part of a hunk, since models often get the counts wrong. A "\\ No newline at end of file"
+    marker clears has_newline on the line before it.
+    Raises ValueError if the diff covers more than one file or a hunk has more lines than its header says.
+    """
+    hunks = []
+    old_remaining = new_remaining = 0
+    last_op = None
+    for line in diff.removesuffix("\n").split("\n"):
+        match = HUNK_HEADER_PATTERN.match(line)
+        if match:
+            count = int(match.group(2)) if match.group(2) is not None else 1
+            old_remaining = count
+            new_remaining = int(match.group(3)) if match.group(3) is not None else 1
+            hunks.append((int(match.group(1)), count, []))
+            last_op = None
+            continue
+        if line.startswith("\\"):
+            if last_op is not None:
+                last_op[2] = False
+            continue
+        if hunks and (line.startswith("--- ") or line.startswith("+++ ")):
+            raise ValueError("diff covers more than one file; send a separate patch for each file")
+
+        in_hunk = old_remaining > 0 or new_remaining > 0
+        if in_hunk and line.startswith("+"):
+            kind = "+"
+            new_remaining -= 1
+        elif in_hunk and line.startswith("-"):
+            kind = "-"
+            old_remaining -= 1
+        elif in_hunk and (line.startswith(" ") or line == ""):
+            # Models sometimes drop the leading space on blank context lines
+            kind = " "
+            old_remaining -= 1
+            new_remaining -= 1
+        else:
+            if hunks and line[:1] in ("+", "-", " "):
+                raise ValueError(f"hunk starting at line {hunks[-1][0]} has more lines than its header says")
+            # File headers and other text outside of hunks, which also ends a short hunk
+            old_remaining = new_remaining = 0
+            last_op = None
+            continue
+        last_op = [kind, line[1:], True]
+        hunks[-1][2].append(last_op)
+    return hunks
+
+def is_new_file_diff(diff):
+    """
+    Returns True if the diff creates a file, which is a single hunk adding lines to an empty file.
+    """
+    hunks = _parse_hunks(diff)
+    return (
+        len(hunks) == 1
+        and hunks[0][:2] == (0, 0)
+        and bool(hunks[0][2])
+        and all(kind == "+" for kind, _, _ in hunks[0][2])
+    )
+
+def _split_lines(content):
+    """
+    Splits content into lines that keep their line endings.
+    """
+    lines = [line + "\n" for line in content.split("\n")]
+    last = lines.pop()[:-1]
+    if last:
+        lines.append(last)
+    return lines
+
+def apply_unified_diff(content, diff):
+    """
+    Applies a unified diff to content and returns the patched content.
+    Hunks are located by their context and removed lines, ignoring trailing whitespace and
+    searching for the match nearest to the line number in the hunk header, so diffs with
+    slightly wrong line numbers still apply. Context lines are kept exactly as they are in the
+    file, and added lines use the file's line ending.
+    Raises ValueError if the diff has no hunks, a hunk can't be located or nothing changes.
+    """
+    hunks = _parse_hunks(diff)
+    if not hunks:
+        raise ValueError("diff has no valid @@ -start,count +start,count @@ hunk headers")
+
+    lines = _split_lines(content)
+    newline = "\r\n" if lines and lines[0].endswith("\r\n") else "\n"
+    offset = 0
+    search_from = 0
+    for start, count, ops in hunks:
+        before = [text.rstrip() for kind, text, _ in ops if kind != "+"]
+        # A hunk with an empty original range inserts after line `start` rather than at it
+        expected = (start if count == 0 else max(start - 1, 0)) + offset
+        if not before:
+            position = min(max(expected, search_from), len(lines))
+        else:
+            candidates = [
+                i for i in range(search_from, len(lines) - len(before) + 1)
+                if [line.rstrip() for line in lines[i:i + len(before)]] == before
+            ]
+            if not candidates:
+                raise ValueError(f"hunk starting at line {start} does not match the file")
+            position = min(candidates, key=lambda i: abs(i - expected))
+
+        replacement = []
+        index = position
+        for kind, text, has_newline in ops:
+            if kind == " ":
+                replacement.append(lines[index])
+                index += 1
+            elif kind == "-":
+                index += 1
+            else:
+                replacement.append(text + (newline if has_newline else ""))
+        lines[position:index] = replacement
+        offset += len(replacement) - (index - position)
+        search_from = position + len(replacement)
+
+    # Only the last line may be missing its line ending
+    for i in range(len(lines) - 1):
+        if not lines[i].endswith("\n"):
+            lines[i] += newline
+
+    patched = "".join(lines)
+    if patched == content:
+        raise ValueError("diff does not change the file")
+    return patched
+
+def _patch_target_error(folder, filename):
+    """
+    Returns why a patch may not write filename in folder, or None if it may.
+    Patches may not leave the folder or touch ignored directories and files.
+    """
+    if os.path.isabs(filename):
+        return "path is absolute"
+    root = os.path.realpath(folder)
+    target = os.path.realpath(os.path.join(folder, filename))
+    if target == root or os.path.commonpath([root, target]) != root:
+        return "path is outside the output folder"
+    parts = filename.split(os.sep)
+    if any(part in IGNORED_DIRECTORIES for part in parts) or parts[-1].endswith(IGNORED_SUFFIXES):
+        return "path is ignored"
+    return None
+
+def apply_patches(folder, files_content, patches):
+    """
+    Applies the patches returned by the model to files_content, which must hold every file
+    read from the output folder so patches to files that weren't sent, such as identical
+    copies, apply to their real content.
+    A patch for a file that wasn't read is only accepted if it creates a file that doesn't
+    exist yet, so files the model never saw, such as state files or files that are too
+    large, are never overwritten. Patches outside the folder or to ignored files are rejected.
+    Returns a dictionary of filename: content for the patched files.
+    Patches that can't be applied are reported and skipped.
     """
     fixed_files = {}
-    lines = fixed_files_text.splitlines()
-    current_file = None
-    current_content = []
-    for line in lines:
-        if line.startswith("[START FILE: "):
-            current_file = line[len("[START FILE: "):-1]  # Remove '[START FILE: ' and trailing ']'
-            current_content = []
-        elif line.strip() == "[END FILE]":
-            if current_file:
-                fixed_files[current_file] = "\n".join(current_content)
-                current_file = None
+    for patch in patches:
+        if not isinstance(patch, dict) or not isinstance(patch.get('filename'), str) or not patch['filename']:
+            continue
+        filename = os.path.normpath(patch['filename'])
+        diff = patch.get('diff') or ''
+        error = _patch_target_error(folder, filename)
+        if error:
+            print(f"Error applying patch to {patch['filename']}: {error}")
+            continue
+        if filename in fixed_files:
+            original = fixed_files[filename]
+        elif filename in files_content:
+            original = files_content[filename]
+        elif os.path.lexists(os.path.join(folder, filename)):
+            print(f"Error applying patch to {filename}: file exists but was not sent to the model")
+            continue
+        elif is_new_file_diff(diff):
+            original = ""
         else:
-            if current_file is not None:
-                current_content.append(line)
+            print(f"Error applying patch to {filename}: file does not exist and the diff does not create it")
+            continue
+        try:
+            fixed_files[filename] = apply_unified_diff(original, diff)
+        except ValueError as e:
+            print(f"Error applying patch to {filename}: {e}")
     return fixed_files
 
+def build_messages(tofu_output, files, original_template, aliases=None):
+    """
+    Builds the chat messages asking the model to fix the files based on the tofu output.
+    `files` is an iterable of (filename, content) pairs, such as `files_content.items()`.
+    `aliases` optionally maps a filename to the other filenames with identical content,
+    which are listed in the prompt instead of being sent again.
+    """
+    aliases = aliases or {}
+
+    # Construct the prompt in one pass rather than by repeated concatenation
+    parts = [
+        "The following is the output from the tofu tool:\n\n",
+        tofu_output,
+        "\n\nHere are the contents of the files:\n\n"
+    ]
+    # Include all files from the output folder
+    for filename, content in files:
+        if filename in aliases:
+            parts.append(f"[IDENTICAL FILES: {', '.join(aliases[filename])} have the same contents as {filename}]\n")
+        parts.append(f"[START FILE: {filename}]\n{content}\n[END FILE]\n\n")
+
+    # Include the original CloudFormation template
+    original_filename, original_content = original_template
+    parts.append(f"[START FILE: {original_filename}]\n{original_content}\n[END FILE]\n\n")
+
+    parts.append("Please fix the files based on the tofu output. Ensure that the Terraform configuration aligns with the provided CloudFormation template. Call apply_patches with a unified diff for each file that needs to change, using the same filenames as the [START FILE] markers. Leave out files that don't need any changes.")
+    prompt = "".join(parts)
+
+    # Prepare the messages for the OpenAI chat
+    messages = [
+        {
+            'role': 'system',
+            'content': 'I am an expert at fixing Terraform files after a migration from CloudFormation. Please provide the output from the Terraform tool and the contents of the files that need to be fixed along with their original CloudFormation templates. I am extremely experienced with AWS.'
+        },
+        {
+            'role': 'user',
+            'content': prompt
+        }
+    ]
+    return messages
+
+def count_tokens(model, text):
+    """
+    Counts the number of tokens in the text using the tokenizer of the given model.
+    """
+    try:
+        encoding = tiktoken.encoding_for_model(model)
+    except KeyError:
+        encoding = tiktoken.get_encoding('o200k_base')
+    return len(encoding.encode(text, disallowed_special=()))
+
+def count_message_tokens(model, messages):
+    """
+    Counts the number of tokens in the content of all messages.
+    """
+    return sum(count_tokens(model, message['content']) for message in messages)
+
+def referenced_files(tofu_output, files_content, aliases=None):
+    """
+    Returns the subset of files_content whose filenames, or the filenames of their
+    aliases, are referenced in the tofu output.
+    """
+    aliases = aliases or {}
+    referenced = set(TF_FILENAME_PATTERN.findall(tofu_output))
+    referenced_basenames = {os.path.basename(name) for name in referenced}
+
+    def is_referenced(filename):
+        return filename in referenced or os.path.basename(filename) in referenced_basenames
+
+    return {
+        filename: content
+        for filename, content in files_content.items()
+        if is_referenced(filename) or any(is_referenced(alias) for alias in aliases.get(filename, []))
+    }
+
+def deduplicate_files(files_content):
+    """
+    Groups files with identical content.
+    Returns a dictionary with one filename: content entry per distinct content, and a
+    dictionary mapping each kept filename to the other filenames with the same content.
+    """
+    by_hash = {}
+    for filename, content in files_content.items():
+        content_hash = hashlib.blake2b(content.encode('utf-8'), digest_size=16).hexdigest()
+        by_hash.setdefault(content_hash, []).append(filename)
+
+    unique_files = {}
+    aliases = {}
+    for filenames in by_hash.values():
+        unique_files[filenames[0]] = files_content[filenames[0]]
+        if len(filenames) > 1:
+            aliases[filenames[0]] = filenames[1:]
+    return unique_files, aliases
+
+def expand_aliases(fixed_files, aliases):
+    """
+    Copies each fixed file to the filenames that had identical content, unless the
+    model returned a separate fix for them.
+    """
+    expanded = dict(fixed_files)
+    for filename, alias_filenames in aliases.items():
+        if filename in fixed_files:
+            for alias in alias_filenames:
+                expanded.setdefault(alias, fixed_files[filename])
+    return expanded
+
+async def select_files_to_fix(client, model, tofu_output, filenames):
+    """
+    Asks the model which of the files need to be edited to fix the tofu output,
+    using a short JSON-only response.
+    Returns the list of selected filenames, or None if the model's answer can't be used.
+    """
+    print("\n--- Asking OpenAI GPT-4 Model which files to fix ---\n")
+    file_list = "\n".join(filenames)
+    messages = [
+        {
+            'role': 'user',
+            'content': f"""Given this terraform error, list ONLY the filenames to edit, chosen from the files below. Respond with a JSON object of the form {{"files": ["filename", ...]}}.
+
+Error:
+{tofu_output[:FILE_SELECTION_OUTPUT_LIMIT]}
+
+Files:
+{file_list}"""
+        }
+    ]
+    try:
+        response = await client.chat.completions.create(
+            model=model,
+            messages=messages,
+            max_tokens=128,
+            response_format={"type": "json_object"}
+        )
+        selected = json.loads(response.choices[0].message.content)["files"]
+    except Exception as e:
+        print(f"Error selecting files to fix: {e}")
+        return None
+    if not isinstance(selected, list) or not selected or not all(isinstance(filename, str) for filename in selected):
+        return None
+    print(f"Selected files: {', '.join(selected)}")
+    return selected
+
+async def fix_files(client, model, output_folder, tofu_output, files_content, original_template, context_limit, select_files=False):
+    """
+    Asks the model to fix the files based on the tofu output.
+    Files with identical content are only sent once and their fix is copied to each copy.
+    If select_files is set, the model is first asked which files need fixing and only those are sent.
+    When the prompt with every file would use too much of the context window, only
+    the files referenced in the tofu output are sent, and if that is still too large
+    they are fixed one file per request, concurrently.
+    Returns the fixed files content as a dictionary.
+    """
+    token_budget = int(context_limit * CONTEXT_USAGE_THRESHOLD)
+    # Patches are applied to every file, even ones that weren't sent
+    all_files = files_content
+    all_filenames = list(files_content)
+    files_content, aliases = deduplicate_files(files_content)
+    if select_files:
+        selected = await select_files_to_fix(client, model, tofu_output, all_filenames)
+        if selected:
+            # Map any selected copy back to the file that is sent for it
+            canonical = {alias: filename for filename, alias_filenames in aliases.items() for alias in alias_filenames}
+            selected = {canonical.get(filename, filename) for filename in selected}
+            selected_files = {filename: content for filename, content in files_content.items() if filename in selected}
+            if selected_files:
+                files_content = selected_files
+    messages = build_messages(tofu_output, files_content.items(), original_template, aliases)
+    if count_message_tokens(model, messages) <= token_budget:
+        return expand_aliases(await send_to_openai(client, model, messages, output_folder, all_files), aliases)
+
+    relevant_files = referenced_files(tofu_output, files_content, aliases)
+    if not relevant_files:
+        print("Prompt exceeds the context budget and no files are referenced in the tofu output. Sending each file separately.")
+        relevant_files = files_content
+    else:
+        print(f"Prompt exceeds the context budget. Restricting to {len(relevant_files)} file(s) referenced in the tofu output.")
+        messages = build_messages(tofu_output, relevant_files.items(), original_template, aliases)
+        if count_message_tokens(model, messages) <= token_budget:
+            return expand_aliases(await send_to_openai(client, model, messages, output_folder, all_files), aliases)
+
+    print(f"Fixing {len(relevant_files)} file(s) one at a time.")
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_FIXES)
+
+    async def fix_one(item):
+        async with semaphore:
+            return await send_to_openai(client, model, build_messages(tofu_output, [item], original_template, aliases), output_folder, all_files, echo=False)
+
+    fixed_files = {}
+    for result in await asyncio.gather(*(fix_one(item) for item in relevant_files.items())):
+        fixed_files.update(result)
+    return expand_aliases(fixed_files, aliases)
+
+def compute_cache_key(model, options, tofu_output, files_content, original_template):
+    """
+    Computes a SHA-256 cache key from the cache format version, the model, the options that
+    change how the model is asked, the tofu output, the files content and the original template.
+    """
+    hasher = hashlib.sha256()
+    hasher.update(f"{CACHE_FORMAT_VERSION}\0{model}\0{json.dumps(options, sort_keys=True)}\0".encode('utf-8'))
+    hasher.update(tofu_output.encode('utf-8'))
+    for filename, content in sorted(files_content.items()):
+        hasher.update(f"\0{filename}\0{content}".encode('utf-8'))
+    original_filename, original_content = original_template
+    hasher.update(f"\0{original_filename}\0{original_content}".encode('utf-8'))
+    return hasher.hexdigest()
+
+def load_cached_fix(cache_dir, cache_key):
+    """
+    Loads previously fixed files from the cache.
+    Returns the fixed files dictionary, or None if there is no usable cache entry.
+    """
+    cache_path = os.path.join(cache_dir, cache_key + ".json")
+    if not os.path.isfile(cache_path):
+        return None
+    try:
+        with open(cache_path, 'r', encoding='utf-8') as file:
+            return json.load(file)
+    except Exception as e:
+        print(f"Error reading cache entry {cache_path}: {e}")
+        return None
+
+def save_cached_fix(cache_dir, cache_key, fixed_files):
+    """
+    Stores the fixed files in the cache so the same failing state doesn't require another OpenAI call.
+    """
+    cache_path = os.path.join(cache_dir, cache_key + ".json")
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(cache_path, 'w', encoding='utf-8') as file:
+            json.dump(fixed_files, file)
+    except Exception as e:
+        print(f"Error writing cache entry {cache_path}: {e}")
+
+def _write_file(output_path, content):
+    """
+    Writes content to a single file as UTF-8 text.
+    """
+    with open(output_path, 'w', encoding='utf-8') as file:
+        file.write(content)
+
 def write_fixed_files(folder, fixed_files):
     """
     Writes the fixed files to the specified folder, preserving subdirectory structure.
+    Directories are created once each and the files are written concurrently using a thread pool.
+    Returns the relative paths of the files written.
     """
-    for filename, content in fixed_files.items():
-        output_path = os.path.join(folder, filename)
-        output_dir = os.path.dirname(output_path)
+    output_paths = {filename: os.path.join(folder, filename) for filename in fixed_files}
+    for output_dir in {os.path.dirname(output_path) for output_path in output_paths.values()}:
         os.makedirs(output_dir, exist_ok=True)
-        try:
-            with open(output_path, 'w', encoding='utf-8') as file:
-                file.write(content)
+
+    written = []
+    max_workers = min(32, (os.cpu_count() or 1) * 4)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            (filename, executor.submit(_write_file, output_paths[filename], content))
+            for filename, content in fixed_files.items()
+        ]
+        for filename, future in futures:
+            output_path = output_paths[filename]
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Error writing file {filename}: {e}")
+                sys.exit(1)
             print(f"Fixed {filename} written to {output_path}")
-        except Exception as e:
-            print(f"Error writing file {filename}: {e}")
-            sys.exit(1)
+            written.append(os.path.relpath(output_path, folder))
+    return written
 
 def initialize_output_folder(input_folder, output_folder):
     """
@@ -210,7 +823,7 @@ def initialize_output_folder(input_folder, output_folder):
     else:
         print(f"Output folder already contains files. Using existing files in {output_folder}.")
 
-def main():
+async def main():
     args = parse_arguments()
 
     # Initialize OpenAI API client
@@ -223,6 +836,12 @@ def main():
     openai_model = args.openai_model
     max_retries = args.max_retries
     sleep_interval = args.sleep_interval
+    max_sleep_interval = args.max_sleep_interval
+    allow_changes = args.allow_changes
+    select_files = args.select_files
+    context_limit = args.context_limit
+    cache_dir = args.cache_dir
+    use_cache = not args.no_cache
 
     # Validate tofu binary
     if not os.path.isfile(tf_bin):
@@ -236,60 +855,73 @@ def main():
     initialize_output_folder(input_folder, output_folder)
     # Read original CloudFormation template
     original_template = read_original_template(original_template_path)
+    # Share providers downloaded by 'tofu init' between output folders
+    tofu_env = tofu_environment()
 
     attempt = 0
+    file_cache = {}
+    seen_cache_keys = set()
+    files_task = None
     while attempt < max_retries:
         print(f"\nAttempt {attempt + 1} of {max_retries}: Running tofu...")
-        exit_code, tofu_output = run_tofu(tf_bin, output_folder)
+        exit_code = 0
+        if not os.path.isdir(os.path.join(output_folder, '.terraform')):
+            # A failed init is fixed like a failed plan
+            print("No .terraform directory found in the output folder. Running tofu init...")
+            exit_code, tofu_output = await init_tofu(tf_bin, output_folder, tofu_env)
+            if exit_code != 0:
+                exit_code = 1
+        if exit_code == 0:
+            exit_code, tofu_output = await run_tofu(tf_bin, output_folder, tofu_env)
 
+        # 'plan -detailed-exitcode' exits with 0 for no changes, 1 for errors and 2 for changes
         if exit_code == 0:
             print("Tofu plan successful. No changes needed.")
             break
+        elif exit_code == 2 and allow_changes:
+            print("Tofu plan successful with changes. Not attempting to fix them.")
+            break
         else:
-            print("Tofu plan failed. Attempting to fix files using OpenAI GPT-4 model.")
-            files_content = read_all_files(output_folder)
-            # Construct the prompt
-            prompt = f"""The following is the output from the tofu tool:
-
-{tofu_output}
-
-Here are the contents of the files:
-
-"""
-            # Include all files from the output folder
-            for filename, content in files_content.items():
-                prompt += f"[START FILE: {filename}]\n{content}\n[END FILE]\n\n"
-
-            # Include the original CloudFormation template
-            original_filename, original_content = original_template
-            prompt += f"[START FILE: {original_filename}]\n{original_content}\n[END FILE]\n\n"
-
-            prompt += """Please fix the files based on the tofu output. Ensure that the Terraform configuration aligns with the provided CloudFormation template. Provide only the fixed file contents with no additional commentary, maintaining the same filenames and the same [START FILE] and [END FILE] markers for each file."""
-
-            # Prepare the messages for the OpenAI chat
-            messages = [
-                {
-                    'role': 'system',
-                    'content': 'I am an expert at fixing Terraform files after a migration from CloudFormation. Please provide the output from the Terraform tool and the contents of the files that need to be fixed along with their original CloudFormation templates. I am extremely experienced with AWS.'
-                },
-                {
-                    'role': 'user',
-                    'content': prompt
-                }
-            ]
-
-            fixed_files = send_to_openai(client, openai_model, messages)
-            write_fixed_files(output_folder, fixed_files)
+            if exit_code == 2:
+                print("Tofu plan has changes. Attempting to fix files using OpenAI GPT-4 model.")
+            else:
+                print("Tofu plan failed. Attempting to fix files using OpenAI GPT-4 model.")
+            if files_task is not None:
+                files_content = await files_task
+            else:
+                files_content = await refresh_files_async(output_folder, file_cache)
+            cache_options = {'select_files': select_files, 'context_limit': context_limit}
+            cache_key = compute_cache_key(openai_model, cache_options, tofu_output, files_content, original_template)
+            fixed_files = None
+            # A key seen earlier in this run means the cached fix didn't work, so ask the model again
+            if use_cache and cache_key not in seen_cache_keys:
+                fixed_files = load_cached_fix(cache_dir, cache_key)
+            seen_cache_keys.add(cache_key)
+            if fixed_files is not None:
+                print("Found cached fix for this tofu output. Skipping OpenAI call.")
+            else:
+                fixed_files = await fix_files(client, openai_model, output_folder, tofu_output, files_content, original_template, context_limit, select_files)
+                # Don't cache a response where no patch could be applied, so the next attempt asks again
+                if fixed_files:
+                    save_cached_fix(cache_dir, cache_key, fixed_files)
+            # Always re-read the files just written, even if their mtime and size look unchanged
+            for filename in write_fixed_files(output_folder, fixed_files):
+                file_cache.pop(filename, None)
 
             print("Re-running tofu with the fixed files.")
 
         attempt += 1
         if attempt < max_retries:
-            print(f"Waiting for {sleep_interval} seconds before next attempt...\n")
-            time.sleep(sleep_interval)
+            # Exponential backoff with jitter
+            delay = sleep_interval + random.uniform(0, sleep_interval * 0.25)
+            print(f"Waiting for {delay:.1f} seconds before next attempt...\n")
+            # Read the files for the next attempt while waiting
+            files_task = asyncio.create_task(refresh_files_async(output_folder, file_cache))
+            await asyncio.sleep(delay)
+            sleep_interval = min(sleep_interval * 2, max_sleep_interval)
         else:
             print("Maximum number of retries reached. Exiting.")
             sys.exit(1)
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())
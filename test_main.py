@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from main import apply_patches, apply_unified_diff, is_new_file_diff
+
+class ApplyUnifiedDiffTest(unittest.TestCase):
+    def test_applies(self):
+        cases = [
+            ("changes a line", "a\nb\nc\n", "@@ -1,3 +1,3 @@\n a\n-b\n+B\n c\n", "a\nB\nc\n"),
+            ("keeps CRLF line endings", "a\r\nb\r\nc\r\n", "@@ -1,3 +1,3 @@\n a\n-b\n+B\n c\n", "a\r\nB\r\nc\r\n"),
+            ("keeps trailing whitespace on context lines", "a  \nb\nc\t\n", "@@ -1,3 +1,3 @@\n a\n-b\n+B\n c\n", "a  \nB\nc\t\n"),
+            ("tolerates wrong line numbers", "a\nb\nc\nd\n", "@@ -1,2 +1,2 @@\n c\n-d\n+D\n", "a\nb\nc\nD\n"),
+            ("inserts after the given line", "a\nb\nc\n", "@@ -2,0 +3,1 @@\n+x\n", "a\nb\nx\nc\n"),
+            ("creates a file", "", "--- /dev/null\n+++ b/new.tf\n@@ -0,0 +1,2 @@\n+a\n+b\n", "a\nb\n"),
+            ("adds the final newline", "a\nb", "@@ -1,2 +1,2 @@\n a\n-b\n\\ No newline at end of file\n+b\n", "a\nb\n"),
+            ("removes the final newline", "a\nb\n", "@@ -1,2 +1,2 @@\n a\n-b\n+b\n\\ No newline at end of file\n", "a\nb"),
+            ("ignores text after the last hunk", "a\nb\n", "@@ -1,2 +1,2 @@\n-a\n+A\n b\nThat fixes it.\n", "A\nb\n"),
+            ("ends a short hunk at the next header", "a\nb\nc\nd\n", "@@ -1,3 +1,3 @@\n-a\n+A\n@@ -4,1 +4,1 @@\n-d\n+D\n", "A\nb\nc\nD\n"),
+        ]
+        for name, content, diff, expected in cases:
+            with self.subTest(name):
+                self.assertEqual(apply_unified_diff(content, diff), expected)
+
+    def test_rejects(self):
+        cases = [
+            ("no hunk header", "a\nb\n", "@@\n-a\n+A\n b\n", "no valid"),
+            ("no change", "a\nb\n", "@@ -1,2 +1,2 @@\n a\n b\n", "does not change"),
+            ("context not in file", "a\nb\n", "@@ -1,2 +1,2 @@\n-x\n+y\n b\n", "does not match"),
+            ("second file", "a\n", "--- a/x.tf\n+++ b/x.tf\n@@ -1 +1 @@\n-a\n+A\n--- a/y.tf\n+++ b/y.tf\n@@ -1 +1 @@\n-a\n+A\n", "more than one file"),
+            ("added line after the hunk", "a\n", "@@ -1 +1 @@\n-a\n+A\n+B\n", "more lines than its header"),
+        ]
+        for name, content, diff, message in cases:
+            with self.subTest(name):
+                with self.assertRaisesRegex(ValueError, message):
+                    apply_unified_diff(content, diff)
+
+    def test_is_new_file_diff(self):
+        self.assertTrue(is_new_file_diff("@@ -0,0 +1 @@\n+a\n"))
+        self.assertFalse(is_new_file_diff("@@ -10,0 +11 @@\n+a\n"))
+        self.assertFalse(is_new_file_diff("@@ -1 +1 @@\n-a\n+b\n"))
+
+class ApplyPatchesTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+        for filename, content in [('main.tf', 'a\n'), ('terraform.tfstate', '{}'), ('big.tf', 'b\n')]:
+            with open(os.path.join(self.folder, filename), 'w', encoding='utf-8') as file:
+                file.write(content)
+        # big.tf is on disk but, like a file that is too large, wasn't read
+        self.files_content = {'main.tf': 'a\n', 'copy.tf': 'a\n'}
+
+    def patch(self, filename, diff):
+        return apply_patches(self.folder, self.files_content, [{'filename': filename, 'diff': diff}])
+
+    def test_patches_files_that_were_read(self):
+        self.assertEqual(self.patch('main.tf', "@@ -1 +1 @@\n-a\n+A\n"), {'main.tf': 'A\n'})
+        self.assertEqual(self.patch('./copy.tf', "@@ -1 +1 @@\n-a\n+A\n"), {'copy.tf': 'A\n'})
+
+    def test_creates_new_files(self):
+        self.assertEqual(self.patch('sub/new.tf', "@@ -0,0 +1 @@\n+x\n"), {'sub/new.tf': 'x\n'})
+
+    def test_rejects_unsafe_targets(self):
+        new_file = "@@ -0,0 +1 @@\n+clobbered\n"
+        for filename in ['terraform.tfstate', 'big.tf', '.terraform/x.tf', '../outside.tf', '/tmp/outside.tf', 'missing.tf']:
+            with self.subTest(filename):
+                diff = new_file if filename != 'missing.tf' else "@@ -1 +1 @@\n-a\n+A\n"
+                self.assertEqual(self.patch(filename, diff), {})
+
+if __name__ == "__main__":
+    unittest.main()